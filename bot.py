@@ -4,6 +4,7 @@ import os
 import sys
 import json
 import time
+from collections import deque
 from typing import Dict, List, Optional
 
 from telegram import (
@@ -12,10 +13,15 @@ from telegram import (
     ReplyKeyboardRemove,
     KeyboardButton,
 )
+from telegram.error import TelegramError
 from telegram.ext import (
+    Application,
     ApplicationBuilder,
+    ApplicationHandlerStop,
+    CallbackContext,
     CommandHandler,
     MessageHandler,
+    TypeHandler,
     ContextTypes,
     filters,
 )
@@ -52,6 +58,8 @@ REPORTED_FILE = os.path.join(DATA_DIR, "reported.json")
 REFERRALS_FILE = os.path.join(DATA_DIR, "referrals.json")
 LIKES_FILE = os.path.join(DATA_DIR, "likes.json")
 MUTES_FILE = os.path.join(DATA_DIR, "mutes.json")
+UPDATES_FILE = os.path.join(DATA_DIR, "updates.json")
+STATE_FILE = os.path.join(DATA_DIR, "state.json")
 
 
 # --- Функции для сохранения/загрузки данных ---
@@ -81,11 +89,63 @@ referrals = load_data(REFERRALS_FILE, {"referrals": {}})["referrals"]
 invited_by = {}
 user_likes: Dict[str, int] = load_data(LIKES_FILE, {"likes": {}})["likes"]
 search_timers: Dict[str, asyncio.Task] = {}
+search_deadlines: Dict[str, float] = {}
+show_name_requests: Dict[tuple, dict] = {}
+# Становится True после post_init: до этого в памяти нет данных прошлого снимка.
+state_restored = False
 
 user_states = {}
 
 AVAILABLE_INTERESTS = ["Музыка", "Игры", "Кино", "Путешествия", "Спорт", "Книги"]
 GENDERS = ["Мужчина", "Женщина", "Другое"]
+SEARCH_TIMEOUT = 120
+PROFILE_SETUP_STATES = ("awaiting_gender", "awaiting_age", "awaiting_city")
+
+# --- Настройки антифлуда ---
+# Token bucket на каждого отправителя: ёмкость задаёт допустимый всплеск,
+# скорость — сколько сообщений в секунду восполняется. Текст и медиа считаются отдельно.
+FLOOD_LIMITS = {
+    "text": (
+        int(os.environ.get('FLOOD_TEXT_BURST', 8)),
+        float(os.environ.get('FLOOD_TEXT_RATE', 1.0)),
+    ),
+    "media": (
+        int(os.environ.get('FLOOD_MEDIA_BURST', 4)),
+        float(os.environ.get('FLOOD_MEDIA_RATE', 0.25)),
+    ),
+}
+# Предупреждение о флуде отправляется не чаще раза за период (в секундах).
+FLOOD_WARN_PERIOD = int(os.environ.get('FLOOD_WARN_PERIOD', 60))
+# После стольких периодов с флудом подряд пользователь автоматически получает мут.
+FLOOD_MUTE_STRIKES = int(os.environ.get('FLOOD_MUTE_STRIKES', 3))
+# Если пользователь не флудил дольше этого времени, счётчик нарушений сбрасывается.
+FLOOD_STRIKE_RESET = int(os.environ.get('FLOOD_STRIKE_RESET', 600))
+
+flood_buckets: Dict[str, Dict[str, tuple]] = {kind: {} for kind in FLOOD_LIMITS}
+flood_warnings: Dict[str, float] = {}
+flood_strikes: Dict[str, int] = {}
+# Последний альбом (media_group_id) каждого пользователя: альбом оплачивается одним токеном.
+flood_media_groups: Dict[str, str] = {}
+
+# --- Настройки дедупликации обновлений ---
+# Telegram повторно доставляет вебхук, если мы отвечаем слишком долго.
+# Храним последние update_id в кольцевом буфере, чтобы не обрабатывать их дважды.
+DEDUP_BUFFER_SIZE = int(os.environ.get('DEDUP_BUFFER_SIZE', 5000))
+# update_id у Telegram только растут, поэтому между перезапусками достаточно хранить
+# максимальный обработанный id. Он сохраняется раз в столько обновлений и при остановке бота.
+# После перезапуска дублями считаются только id из окна DEDUP_BUFFER_SIZE перед ним:
+# если Telegram после долгого простоя начнёт нумерацию заново, новые обновления не потеряются.
+DEDUP_SAVE_EVERY = int(os.environ.get('DEDUP_SAVE_EVERY', 50))
+
+_updates_data = load_data(UPDATES_FILE, {})
+recent_update_ids = deque(maxlen=DEDUP_BUFFER_SIZE)
+recent_update_ids_set = set()
+update_stats = {
+    "restored_update_id": _updates_data.get("last_update_id", 0),
+    "last_update_id": _updates_data.get("last_update_id", 0),
+    "duplicates_dropped": _updates_data.get("duplicates_dropped", 0),
+    "unsaved": 0,
+}
 
 # --- Обработчики ошибок ---
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -94,6 +154,179 @@ async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> N
     if update and update.effective_chat:
         logging.error(f"Обновление {update} вызвало ошибку в чате {update.effective_chat.id}")
 
+# --- Дедупликация обновлений ---
+def save_update_ids() -> None:
+    """Сохраняет максимальный обработанный update_id и счётчик отброшенных дублей."""
+    save_data({
+        "last_update_id": update_stats["last_update_id"],
+        "duplicates_dropped": update_stats["duplicates_dropped"],
+    }, UPDATES_FILE)
+    update_stats["unsaved"] = 0
+
+async def dedup_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Останавливает обработку повторно доставленных обновлений."""
+    update_id = update.update_id
+    restored_update_id = update_stats["restored_update_id"]
+    if update_id in recent_update_ids_set or restored_update_id - DEDUP_BUFFER_SIZE < update_id <= restored_update_id:
+        update_stats["duplicates_dropped"] += 1
+        logging.info(f"Duplicate update {update_id} dropped")
+        raise ApplicationHandlerStop
+
+    if len(recent_update_ids) == recent_update_ids.maxlen:
+        recent_update_ids_set.discard(recent_update_ids[0])
+    recent_update_ids.append(update_id)
+    recent_update_ids_set.add(update_id)
+    update_stats["last_update_id"] = max(update_stats["last_update_id"], update_id)
+
+    update_stats["unsaved"] += 1
+    if update_stats["unsaved"] >= DEDUP_SAVE_EVERY:
+        save_update_ids()
+
+# --- Сохранение состояния между перезапусками ---
+def save_state() -> None:
+    """Сохраняет снимок состояния, которое иначе живёт только в памяти."""
+    save_data({
+        "waiting_users": waiting_users,
+        "search_deadlines": {uid: search_deadlines[uid] for uid in waiting_users if uid in search_deadlines},
+        "user_states": user_states,
+        # Незаконченные анкеты пишутся в PROFILES_FILE только на последнем шаге.
+        "user_profiles": {
+            uid: user_profiles[uid] for uid, state in user_states.items()
+            if state in PROFILE_SETUP_STATES and uid in user_profiles
+        },
+        "user_interests": user_interests,
+        "invited_by": invited_by,
+        "show_name_requests": [
+            {"users": list(chat_key), "answers": answers}
+            for chat_key, answers in show_name_requests.items()
+        ],
+    }, STATE_FILE)
+    logging.info(f"State saved: {len(waiting_users)} waiting users, {len(user_states)} user states")
+
+async def restore_state(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Восстанавливает снимок состояния и заново запускает таймеры поиска."""
+    # Сначала разбираем и проверяем весь снимок, чтобы при ошибке ничего не применить частично.
+    try:
+        state = load_data(STATE_FILE, {})
+        if not state:
+            return
+        if not isinstance(state, dict):
+            raise TypeError("снимок должен быть словарём")
+
+        restored_states = {str(uid): str(value) for uid, value in dict(state.get("user_states", {})).items()}
+        restored_profiles = {str(uid): dict(profile) for uid, profile in dict(state.get("user_profiles", {})).items()}
+        restored_interests = {str(uid): list(items) for uid, items in dict(state.get("user_interests", {})).items()}
+        restored_invited_by = {str(uid): str(referrer) for uid, referrer in dict(state.get("invited_by", {})).items()}
+        restored_requests = {}
+        for entry in state.get("show_name_requests", []):
+            chat_key = tuple(sorted(str(uid) for uid in entry["users"]))
+            if len(chat_key) != 2:
+                raise ValueError(f"неверная пара в show_name_requests: {chat_key}")
+            restored_requests[chat_key] = dict(entry["answers"])
+        deadlines = {str(uid): float(deadline) for uid, deadline in dict(state.get("search_deadlines", {})).items()}
+        restored_waiting = [str(uid) for uid in state.get("waiting_users", [])]
+    except (ValueError, KeyError, TypeError, AttributeError) as e:
+        logging.error(f"Не удалось восстановить снимок состояния: {e}")
+        return
+
+    user_states.update(restored_states)
+    for user_id, profile in restored_profiles.items():
+        user_profiles.setdefault(user_id, {}).update(profile)
+    for user_id, user_state in restored_states.items():
+        if user_state in PROFILE_SETUP_STATES:
+            user_profiles.setdefault(user_id, {})
+    user_interests.update(restored_interests)
+    invited_by.update(restored_invited_by)
+    for chat_key, answers in restored_requests.items():
+        if chat_key[0] in active_chats:
+            show_name_requests[chat_key] = answers
+
+    now = time.time()
+    for user_id in restored_waiting:
+        if user_id in waiting_users or user_id in active_chats:
+            continue
+        waiting_users.append(user_id)
+        search_deadlines[user_id] = deadlines.get(user_id, now + SEARCH_TIMEOUT)
+        timeout = max(0, search_deadlines[user_id] - now)
+        search_timers[user_id] = asyncio.create_task(cancel_search_after_timeout(user_id, context, timeout))
+
+    # Снимок одноразовый: после аварийного падения устаревшие данные не должны вернуться.
+    os.remove(STATE_FILE)
+    logging.info(f"State restored: {len(waiting_users)} waiting users, {len(user_states)} user states")
+
+    try:
+        await find_partner(context)
+    except TelegramError as e:
+        logging.error(f"Ошибка при поиске пары после восстановления состояния: {e}")
+
+async def post_init(application: Application) -> None:
+    """Восстанавливает состояние до того, как бот начнёт принимать обновления."""
+    global state_restored
+    await restore_state(CallbackContext(application))
+    state_restored = True
+
+async def post_shutdown(application: Application) -> None:
+    """Сохраняет состояние перед завершением работы бота."""
+    save_update_ids()
+    # Если запуск упал до post_init, снимок прошлого процесса нельзя затирать пустым.
+    if state_restored:
+        save_state()
+    else:
+        logging.warning("State snapshot was not restored, skipping save")
+
+# --- Антифлуд ---
+def consume_flood_token(user_id: str, kind: str) -> bool:
+    """Списывает токен из корзины пользователя. Возвращает False, если лимит исчерпан."""
+    capacity, rate = FLOOD_LIMITS[kind]
+    now = time.monotonic()
+    tokens, last = flood_buckets[kind].get(user_id, (capacity, now))
+    tokens = min(capacity, tokens + (now - last) * rate)
+    if tokens < 1:
+        flood_buckets[kind][user_id] = (tokens, now)
+        return False
+    flood_buckets[kind][user_id] = (tokens - 1, now)
+    return True
+
+def prune_flood_warnings(now: float) -> None:
+    """Удаляет устаревшие предупреждения и счётчики нарушений всех пользователей."""
+    for uid, last_warning in list(flood_warnings.items()):
+        if now - last_warning > FLOOD_STRIKE_RESET:
+            flood_warnings.pop(uid, None)
+            flood_strikes.pop(uid, None)
+
+async def handle_flood(user_id: str, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Предупреждает флудера раз в период, а при повторных нарушениях выдаёт мут."""
+    now = time.monotonic()
+    last_warning = flood_warnings.get(user_id)
+    if last_warning is not None and now - last_warning < FLOOD_WARN_PERIOD:
+        return
+    # Заодно чистим чужие истёкшие нарушения: это происходит не чаще раза за период на флудера.
+    prune_flood_warnings(now)
+
+    flood_warnings[user_id] = now
+    flood_strikes[user_id] = flood_strikes.get(user_id, 0) + 1
+
+    if flood_strikes[user_id] >= FLOOD_MUTE_STRIKES:
+        flood_strikes.pop(user_id, None)
+        muted_users.add(user_id)
+        save_data({"muted": list(muted_users)}, MUTES_FILE)
+        logging.info(f"User {user_id} was auto-muted for flooding")
+        await context.bot.send_message(user_id, "🔇 Вы были автоматически заглушены за флуд. Вы можете завершить чат, но не можете отправлять сообщения.")
+        return
+
+    await context.bot.send_message(user_id, "⚠️ Вы отправляете сообщения слишком часто. Лишние сообщения не доставлены собеседнику.")
+
+def forget_flood_state(user_id: str) -> None:
+    """Удаляет антифлуд-данные пользователя после чата, чтобы словари не росли бесконечно."""
+    for buckets in flood_buckets.values():
+        buckets.pop(user_id, None)
+    flood_media_groups.pop(user_id, None)
+    # Недавние нарушения сохраняем, чтобы завершением чата нельзя было обойти авто-мут.
+    last_warning = flood_warnings.get(user_id)
+    if last_warning is not None and time.monotonic() - last_warning > FLOOD_STRIKE_RESET:
+        flood_warnings.pop(user_id, None)
+        flood_strikes.pop(user_id, None)
+
 # --- Команды и основная логика ---
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обрабатывает команду /start."""
@@ -236,6 +469,9 @@ async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 
     # Если пользователь в чате, пересылаем сообщение собеседнику
     if user_id in active_chats:
+        if not consume_flood_token(user_id, "text"):
+            await handle_flood(user_id, context)
+            return
         partner_id = active_chats[user_id]
         await context.bot.send_message(partner_id, text)
         return
@@ -285,6 +521,13 @@ async def media_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
         return
         
     if user_id in active_chats:
+        media_group_id = update.message.media_group_id
+        if media_group_id is None or flood_media_groups.get(user_id) != media_group_id:
+            if not consume_flood_token(user_id, "media"):
+                await handle_flood(user_id, context)
+                return
+            if media_group_id is not None:
+                flood_media_groups[user_id] = media_group_id
         partner_id = active_chats[user_id]
         await context.bot.forward_message(
             chat_id=partner_id,
@@ -341,6 +584,7 @@ async def start_search(user_id: str, context: ContextTypes.DEFAULT_TYPE) -> None
     waiting_users.append(user_id)
     await show_search_menu(user_id, context)
     
+    search_deadlines[user_id] = time.time() + SEARCH_TIMEOUT
     search_timers[user_id] = asyncio.create_task(cancel_search_after_timeout(user_id, context))
     
     await find_partner(context)
@@ -358,6 +602,8 @@ async def find_partner(context: ContextTypes.DEFAULT_TYPE) -> None:
         if user2_id in search_timers:
             search_timers[user2_id].cancel()
             search_timers.pop(user2_id, None)
+        search_deadlines.pop(user1_id, None)
+        search_deadlines.pop(user2_id, None)
             
         active_chats[user1_id] = user2_id
         active_chats[user2_id] = user1_id
@@ -389,12 +635,13 @@ async def find_partner(context: ContextTypes.DEFAULT_TYPE) -> None:
         await show_chat_menu(user1_id, context)
         await show_chat_menu(user2_id, context)
         
-async def cancel_search_after_timeout(user_id: str, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Автоматически отменяет поиск через 2 минуты."""
-    await asyncio.sleep(120)
+async def cancel_search_after_timeout(user_id: str, context: ContextTypes.DEFAULT_TYPE, timeout: float = SEARCH_TIMEOUT) -> None:
+    """Автоматически отменяет поиск по истечении времени ожидания."""
+    await asyncio.sleep(timeout)
     if user_id in waiting_users:
         waiting_users.remove(user_id)
         search_timers.pop(user_id, None)
+        search_deadlines.pop(user_id, None)
         await context.bot.send_message(
             user_id,
             "⏳ Время поиска истекло. Попробуйте ещё раз.",
@@ -409,6 +656,7 @@ async def cancel_search(user_id: str, context: ContextTypes.DEFAULT_TYPE) -> Non
         if user_id in search_timers:
             search_timers[user_id].cancel()
             search_timers.pop(user_id, None)
+        search_deadlines.pop(user_id, None)
         await context.bot.send_message(user_id, "❌ Поиск отменён.", reply_markup=ReplyKeyboardRemove())
         await show_main_menu(user_id, context)
     else:
@@ -420,6 +668,8 @@ async def end_chat(user_id: str, context: ContextTypes.DEFAULT_TYPE) -> None:
         partner_id = active_chats.pop(user_id)
         active_chats.pop(partner_id, None)
         save_data(active_chats, CHATS_FILE)
+        forget_flood_state(user_id)
+        forget_flood_state(partner_id)
         
         chat_key = tuple(sorted((user_id, partner_id)))
         show_name_requests.pop(chat_key, None)
@@ -663,7 +913,8 @@ async def admin_menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE)
             f"⚠️ Жалоб: {len(reported_users['reports'])}\n"
             f"⛔ Забанено: {len(banned_users)}\n"
             f"🔇 В муте: {len(muted_users)}\n"
-            f"🔗 Всего рефералов: {sum(referrals.values())}"
+            f"🔗 Всего рефералов: {sum(referrals.values())}\n"
+            f"🔁 Отброшено повторных обновлений: {update_stats['duplicates_dropped']}"
         )
     elif text == "♻️ Завершить все чаты":
         active_chat_users = list(active_chats.keys())
@@ -698,8 +949,19 @@ def main() -> None:
     """Запускает бота в режиме вебхуков."""
     PORT = int(os.environ.get('PORT', 5000))
     
-    app = ApplicationBuilder().token(BOT_TOKEN).build()
+    # run_webhook по SIGTERM/SIGINT сначала останавливает приём вебхуков, дожидается
+    # обработки текущих обновлений и только потом вызывает post_shutdown со снимком состояния.
+    app = (
+        ApplicationBuilder()
+        .token(BOT_TOKEN)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
     
+    # Отбрасываем повторно доставленные обновления до всех остальных обработчиков
+    app.add_handler(TypeHandler(Update, dedup_handler), group=-1)
+
     # Обработчики
     app.add_handler(CommandHandler('start', start_command))
     app.add_handler(CommandHandler('admin', admin_command))